@@ -1,5 +1,10 @@
 
-import requests
+import asyncio
+import hashlib
+import tempfile
+import threading
+import time
+import aiohttp
 
 from sec_api import QueryApi
 
@@ -13,8 +18,155 @@ from ai_api import AiApi
 open_ai_key = os.environ.get('OPENAI_API_KEY')
 app = AiApi(openai_api_key=open_ai_key, LOG_LEVEL="DEBUG")
 
+SEC_HEADERS = {
+    'User-Agent': 'Hedgineer Services LLC info@hedgineer.io'
+}
+RETRY_STATUSES = {429, 502, 503, 504}
+
+# SEC's fair access policy allows 10 requests per second across everything this process sends
+SEC_REQUESTS_PER_SECOND = 10
+_rate_lock = threading.Lock()
+_next_request_at = 0.0
+
+# Filings never change once filed so their text is cached on disk by URL
+FILING_CACHE_DIR = pathlib.Path(os.environ.get("SEC_FILING_CACHE", "~/.cache/ai_api_sec")).expanduser()
+# Least recently used filings are deleted once the cache grows past this size
+FILING_CACHE_MAX_BYTES = int(os.environ.get("SEC_FILING_CACHE_MAX_BYTES", 1024 ** 3))
+
+# Shared per event loop so requests to sec.gov reuse keepalive connections
+_session = None
+_session_loop = None
+
+def sec_session() -> aiohttp.ClientSession:
+    global _session, _session_loop
+
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        _session = aiohttp.ClientSession(
+            headers=SEC_HEADERS,
+            connector=aiohttp.TCPConnector(limit=20, limit_per_host=10),
+            timeout=aiohttp.ClientTimeout(total=10)
+        )
+        _session_loop = loop
+
+    return _session
+
+async def close_sec_session():
+    '''
+    Closes the shared session, awaited before the event loop that created it finishes
+    '''
+
+    global _session
+
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+async def sec_rate_limit():
+    '''
+    Waits for the next free slot so requests to sec.gov are spaced evenly under the rate limit.
+    Slots are reserved under a thread lock so concurrent queries, on any event loop, share the limit.
+    '''
+
+    global _next_request_at
+
+    with _rate_lock:
+        now = time.monotonic()
+        request_at = max(now, _next_request_at)
+        _next_request_at = request_at + 1 / SEC_REQUESTS_PER_SECOND
+
+    await asyncio.sleep(request_at - now)
+
+async def get_text(url: str, retries: int = 3, backoff: float = 0.5) -> str:
+    '''
+    Fetches the text at url, retrying rate limited and gateway errors with exponential backoff
+    '''
+
+    for attempt in range(retries + 1):
+        await sec_rate_limit()
+        async with sec_session().get(url) as r:
+            if r.status not in RETRY_STATUSES or attempt == retries:
+                r.raise_for_status()
+                return await r.text()
+
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+def _read_cached_filing(path: pathlib.Path):
+    try:
+        text = path.read_text(encoding='utf-8')
+        # The modified time marks when a filing was last used for evicting the least recently used
+        os.utime(path)
+        return text
+    except FileNotFoundError:
+        return None
+
+def _write_cached_filing(path: pathlib.Path, text: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Every write gets its own temp file so concurrent fetches of the same filing don't share one
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=path.parent, suffix='.tmp', delete=False) as f:
+        f.write(text)
+    try:
+        os.replace(f.name, path)
+    except OSError:
+        os.unlink(f.name)
+        raise
+
+    _evict_cached_filings(path.parent)
+
+def _evict_cached_filings(cache_dir: pathlib.Path):
+    files = []
+    for file in cache_dir.glob('*.txt'):
+        try:
+            files.append((file.stat(), file))
+        except FileNotFoundError:
+            # Evicted by a concurrent write
+            continue
+
+    total = sum(stat.st_size for stat, _ in files)
+    for stat, file in sorted(files, key=lambda x: x[0].st_mtime):
+        if total <= FILING_CACHE_MAX_BYTES:
+            break
+        file.unlink(missing_ok=True)
+        total -= stat.st_size
+
+async def get_filing_text(url: str) -> str:
+    '''
+    Fetches the text of a filing, reading it from the on disk cache when it was downloaded before
+    '''
+
+    path = FILING_CACHE_DIR / f"{hashlib.sha1(url.encode()).hexdigest()}.txt"
+    if (text := await asyncio.to_thread(_read_cached_filing, path)) is not None:
+        return text
+
+    text = await get_text(url)
+    await asyncio.to_thread(_write_cached_filing, path, text)
+    return text
+
+async def find_filings(ticker: str, form_type: str, size: int) -> list:
+    '''
+    Looks up the most recent filings for a company and form type, newest first
+    '''
+
+    api_key = os.getenv("SEC_API_KEY")  # Replace with your own API key
+    query_api = QueryApi(api_key=api_key)
+
+    query = {
+        "query": {
+            "query_string": {
+                "query": f"ticker:{ticker} AND formType:{form_type}"
+            }
+        },
+        "from": "0",
+        "size": str(size),
+        "sort": [{"filedAt": {"order": "desc"}}]
+    }
+
+    filings = await asyncio.to_thread(query_api.get_filings, query)
+    return filings['filings']
+
 @app.register_api()
-def fetch_sec_filings(ticker: str, form_type: str) -> str:
+async def fetch_sec_filings(ticker: str, form_type: str) -> str:
     '''
      Fetches the most recent SEF filing for a company and form type.
 
@@ -36,28 +188,46 @@ def fetch_sec_filings(ticker: str, form_type: str) -> str:
         form_text = fetch_sec_filings(ticker, form_type)    
     '''
 
-    api_key = os.getenv("SEC_API_KEY")  # Replace with your own API key
-    query_api = QueryApi(api_key=api_key)
-
-    query = {
-        "query": {
-            "query_string": {
-                "query": f"ticker:{ticker} AND formType:{form_type}"
-            }
-        },
-        "from": "0",
-        "size": "1",
-        "sort": [{"filedAt": {"order": "desc"}}]
-    }
-
-    headers = {
-        'User-Agent': 'Hedgineer Services LLC info@hedgineer.io'
-    }
-    filings = query_api.get_filings(query)
-    if filing := filings['filings']:
-        r = requests.get(filing[0]['linkToTxt'], headers=headers)
-        return r.text
+    if filing := await find_filings(ticker, form_type, size=1):
+        return await get_filing_text(filing[0]['linkToTxt'])
     else:
         return None
 
-print(app.execute_query("What was the most recent insider transaction for GM"))
\ No newline at end of file
+@app.register_api()
+async def fetch_recent_sec_filings(ticker: str, form_type: str, count: int = 5) -> list:
+    '''
+    Fetches the most recent SEC filings for a company and form type, newest first.
+
+    Args:
+        ticker (str): The stock symbol (eg. AAPL, IBM, GM)
+        form_type (str): Filing type (eg. 4, 10-K, 10-Q)
+        count (int): The number of filings to fetch
+
+    Returns:
+        List: The exact text of each filing submitted to the SEC
+
+        example:
+        ["SEC-Document-Text: 0001193125-20-001385.txt This transaction wqs made pursuant to the provisions"]
+
+    Code Example:
+
+        ticker = "AAPL"
+        form_type = "10-Q"
+
+        form_texts = fetch_recent_sec_filings(ticker, form_type, count=4)
+    '''
+
+    filings = await find_filings(ticker, form_type, size=count)
+
+    # get_text keeps the concurrent fetches under SEC's rate limit
+    return await asyncio.gather(*(get_filing_text(f['linkToTxt']) for f in filings))
+
+async def main():
+    # Runs in a single event loop so the sessions can be closed before it finishes
+    try:
+        print(await app.execute_query_async("What was the most recent insider transaction for GM"))
+    finally:
+        await close_sec_session()
+        await app.aclose()
+
+asyncio.run(main())
\ No newline at end of file
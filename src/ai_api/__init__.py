@@ -1,87 +1,177 @@
 import os
+import io
+import re
 import json
 import sys
+import copy
+import textwrap
+import asyncio
+import hashlib
+import functools
+import threading
+import contextvars
+import concurrent.futures
+import inspect
+import weakref
+import aiohttp
 import openai
 from loguru import logger
 
-from typing import Callable, Any
-from pydantic import BaseModel
+from typing import Callable, Any, List, Tuple, Union
+from collections import OrderedDict
+from pydantic import BaseModel, Extra, Field, create_model, root_validator
 
+try:
+    import orjson
+
+    def _json_dumps(obj: Any) -> str:
+        # API results can hold numpy arrays and scalars (eg. from pandas), serialized natively here
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    _json_loads = orjson.loads
+except ImportError:
+    _json_dumps = json.dumps
+    _json_loads = json.loads
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _add_log_handler(level: str) -> int:
+    return logger.add(sys.stderr, format="{time} {level} {message}", level=level, backtrace=True, diagnose=True)
+
+
+def _set_log_level(level: str):
+    '''
+    Replaces the module's log handler with one at the given level. Every AiApi instance shares the
+    one handler so creating instances doesn't add more sinks and duplicate the logs.
+    '''
+
+    global _log_handler_id
+
+    logger.remove(_log_handler_id)
+    _log_handler_id = _add_log_handler(level)
+
+
+# Swap loguru's default handler for ours so messages aren't logged twice
+try:
+    logger.remove(0)
+except ValueError:
+    pass
+_log_handler_id = _add_log_handler(os.environ.get("AIAPI_LOG_LEVEL", "INFO"))
 
 
 class ApiSpec(BaseModel):
     '''
-    The API specification for exposing the API to the generaive AI
+    The API specification for exposing the API to the generaive AI. The spec is validated on
+    construction and raises a pydantic.ValidationError if it is invalid.
     '''
 
     name: str
     description: str
-    args: list
+    args: List[Union[str, Tuple[str, str, str]]]
     code_example: str
     results_description: str
     example_results: list
-    example_query: list
-    example_response: list
-    example_kwargs: list
-
-    def verify_dict(spec: dict) -> bool:
-        '''
-        Verifies if a spec dictionary is valid with required arguments, all in the correct type. If error
-        raises an Assertion Error
-        '''
-
-        assert 'name' in spec, 'Missing the name in the the api spec'
-        required_args = [
-            'name', 
-            'description', 
-            'args', 
-            'code_example', 
-            'results_description',
-            'example_results',
-            'example_query',
-            'example_response',
-            'example_kwargs'
-        ]
+    example_query: List[str]
+    example_response: List[str]
+    example_kwargs: List[dict]
 
-        for i in required_args:
-            assert i in spec, f"Missing the {i} value for the api spec for {spec['name']}"
+    @root_validator(skip_on_failure=True)
+    def _check_examples(cls, values):
+        example_lens = {len(values[i]) for i in ('example_results', 'example_query', 'example_response', 'example_kwargs')}
 
-        assert type(spec['args']) == list, f"Spec args be a list for the {spec['name']} API"
+        if len(example_lens) != 1:
+            raise ValueError('Example Results, Query, Response, and Kwargs must all be the same length')
+        if 0 in example_lens:
+            raise ValueError("There must be at least 1 set of Example Results, Query and Response")
 
-        example_keys = ('example_results', 'example_query', 'example_response', 'example_kwargs')
-        
-        for _example in example_keys:
-            assert type(spec[_example]) == list, \
-            f'{_example} must be a list'
-        
-        example_len = None
-        for _example in example_keys:
-            if example_len is None:
-                example_len = len(spec[_example])
-            else:
-                assert len(spec[_example]) == example_len, \
-                'Example Results, Query, Response, and Kwargs but all be the same length'
+        return values
+    
+# Everything in the identify prompts is fixed until an API is registered so they form a byte identical
+# prefix across queries that the provider's prompt caching can reuse. The API documentation is the
+# bulk of the prompt so it goes in a message of its own that can be cached as a separate chunk
+_IDENTIFY_DOCS_PROMPT = textwrap.dedent("""
+    List of APIs:
+    {api_list}
 
-        assert len(set(map(len, (spec[i] for i in example_keys)))) == 1, \
-            'Example Results, Example Query, and Example Response must all be equal length'
+    Documentation for each API are as follows:
+
+    {api_documentation}
+    """)
+
+_IDENTIFY_SYSTEM_PROMPT = textwrap.dedent("""
+    Your job is to identify APIs that need to be called to answer a user query.
+    You MUST ONLY reply in JSON format. DO not include additional text in your reply.
+    You will be given a list of APIs to choose from any you must identify what APIs you need to call and what arguments to pass to them.
+    You ONLY reply with JSON formatted text that includes the API name and the kwargs to pass to it. Below is an example:
+
+    Example:
+    {
+        "apis": [
+            {"name": "api_name", "kwargs": {"arg1": "value1", "arg2": "value2"}
+        ],
+        "notes": "Additional notes go here if needed"
+    }
+
+    Only use the APIs listed above.
+    """)
+
+
+def _build_api_prompts(api_names: list, api_docs: list, cache_control: dict = None) -> list:
+    '''
+    Builds the prompts for identifying the APIs to call from each API's name and documentation.
+    Kept at the module level so it can be pickled and run in a process pool.
+
+    When cache_control is given (eg. {"type": "ephemeral"}) the documentation is sent as a content
+    part carrying it, marking it as a cache breakpoint for providers and gateways that support it.
+    '''
+
+    docs_prompt = _IDENTIFY_DOCS_PROMPT.format(
+        api_list="\n".join(api_names),
+        api_documentation="\n".join(api_docs)
+    )
+
+    if cache_control:
+        docs_prompt = [{'type': 'text', 'text': docs_prompt, 'cache_control': cache_control}]
+
+    return [
+        {'role': 'system', 'content': docs_prompt},
+        {'role': 'system', 'content': _IDENTIFY_SYSTEM_PROMPT}
+    ]
+
+
+_ANSWER_SYSTEM_PROMPT = textwrap.dedent("""
+    You are an assistant that answers a user query using supplemenal API informatin.
+    Results include the api used, the arguments passed to it, and the results of the call.
+    Answer the question as best you can with this information.
+    DO NOT reference the APIs that were used in the response.
+
+    Below is a description of the APIs used and how to interpret their results:
+    {api_documentation}
+    """)
+
+
+# Seconds between checks on the status of a batch, doubling from the min up to the max
+_BATCH_POLL_MIN = 1
+_BATCH_POLL_MAX = 60
 
-        for arg in spec['args']:
-            assert type(arg) == str or type(arg) in (list, tuple) and len(arg) == 3, \
-            f"Arg value in spec must be a list of len == 4 (name, type, desc)"
-        
-        assert len(spec['example_results']) > 0, \
-            "There must be at least 1 set of Example Resuls, Query and Response"
-        
-        for kwarg in spec['example_kwargs']:
-            assert isinstance(kwarg, dict)
 
-        return True
-    
 class AiApi():
 
-    def __init__(self, model="gpt-3.5-turbo", openai_api_key="", api_temperature=0, answer_temperature=.3, LOG_LEVEL="INFO"):
+    # Wraps each query sent to the AI, can be overridden per instance
+    template_prompt_api_identify = 'Identify what APIs with corresponding arguments need to be called to answer this query: "{0}"'
+
+    def __init__(self, model="gpt-3.5-turbo", openai_api_key="", api_temperature=0, answer_temperature=.3, LOG_LEVEL=None,
+                 identify_cache_size=128, identify_batch_size=16, identify_batch_wait_ms=0, stream_identify=False,
+                 prompt_executor=None, embedding_model=None, semantic_cache_size=256, semantic_cache_threshold=.93,
+                 api_workers=None, structured_output=False, cache_api_docs=False, json_mode=False,
+                 identify_max_tokens=None):
 
-        logger.add(sys.stderr, format="{time} {level} {message}", level=LOG_LEVEL, backtrace=True, diagnose=True)
+        if LOG_LEVEL:
+            _set_log_level(LOG_LEVEL)
         
         if not openai_api_key:
             openai_api_key = os.environ.get('OPENAI_API_KEY')
@@ -91,21 +181,76 @@ class AiApi():
         self.model = model
         self.api_temperature = api_temperature
         self.answer_temperature = answer_temperature
+        self.stream_identify = stream_identify
+
+        # Requires a model that supports structured outputs (eg. gpt-4o). Constrains the identify reply
+        # to the JSON shape of an identify result naming registered APIs. The schema isn't strict, since
+        # that can't express free-form kwargs, so the reply is still parsed and checked as before
+        self.structured_output = structured_output
+
+        # JSON mode (eg. gpt-3.5-turbo-0125 and later) only guarantees the reply is valid JSON, for models
+        # without structured outputs. Capping the identify reply's tokens stops it running on into prose
+        self.json_mode = json_mode
+        self.identify_max_tokens = identify_max_tokens
+
+        # Marks the API documentation message with cache_control for providers that take explicit
+        # cache breakpoints rather than caching prompt prefixes automatically
+        self.cache_api_docs = cache_api_docs
+
+        # Optional concurrent.futures executor (eg. a ProcessPoolExecutor) for building the identify
+        # prompt off the event loop when a large number of APIs are registered
+        self.prompt_executor = prompt_executor
+
+        # Thread pool for running sync APIs, created on first use. The default executor used by
+        # asyncio.to_thread is shut down by every asyncio.run so its threads can't be reused
+        self.api_workers = api_workers
+        self._executor = None
         self._apis = {}
 
+        # Pooled aiohttp session for the OpenAI requests made on each event loop. Without one the
+        # openai client opens a new session and connection for every request
+        self._http_sessions = weakref.WeakKeyDictionary()
+
         self._api_prompts = []
-        self.template_prompt_api_identify = 'Identify what APIs with corresponding arguments need to be called to answer this query: "{0}"'
+        self._prompt_version = None
+
+        # LRU cache of identified API calls keyed by (model, prompt version, query)
+        self.identify_cache_size = identify_cache_size
+        self._identify_cache = OrderedDict()
+        # The sync methods can be called from several threads, each running its own event loop
+        self._identify_cache_lock = threading.Lock()
+
+        # When an embedding model is given, queries similar to a previous one reuse its API calls
+        self.embedding_model = embedding_model
+        self._semantic_cache = None
+        if embedding_model:
+            self._semantic_cache = SemanticCache(max_size=semantic_cache_size, threshold=semantic_cache_threshold)
+
+        # Answer prompts only depend on the set of APIs used
+        self._answer_prompts_cache = {}
+
+        # Coalesces identify requests from concurrent queries into a single batch
+        self._identify_batcher = AsyncBatcher(
+            self._request_api_calls_batch,
+            max_batch=identify_batch_size,
+            max_wait_ms=identify_batch_wait_ms
+        )
 
         pass
 
 
-    def register_api(self, use_doc_str:bool=True, **kwargs):
+    def register_api(self, use_doc_str:bool=True, name:str=None, validate_kwargs:bool=False, dedupe:bool=False,
+                     **kwargs):
         """
         Register Function for being accessble to the the LLL Model
 
         Args:
-            name (str): The unique name for the function
             use_doc_str (bool): Use the docstring of the function for the AI Documentation
+            name (str): The unique name for the function, defaults to the function's __name__
+            validate_kwargs (bool): Validate and coerce the kwargs chosen by the AI against the function's
+                type hints before calling it, raising a pydantic.ValidationError if they don't match
+            dedupe (bool): Run identical calls to the API in a query only once and share the result. Only
+                for APIs that are deterministic and have no side effects
 
             Optional additioonal arguments for the ApiSpecifictions:
             api_dict (dict): Dictionary for the JSON Spec
@@ -116,24 +261,23 @@ class AiApi():
         
         spec = None
         if api_dict := kwargs.get('api_dict'):
-            ApiSpec.verify_dict(api_dict)
-            spec = ApiSpec(**api_dict)
+            spec = ApiSpec.parse_obj(api_dict)
         elif api_spec := kwargs.get('api_spec'):
             assert isinstance(api_spec, ApiSpec), \
                 "api_spec value must be an ApiSpec instance when registering API."
-            ApiSpec.verify_dict(dict(api_spec))
             spec = api_spec
        
         def registered_function(func):
 
-            def wrapped_func(*args, **kwargs):
-                
-                return func(*args, **kwargs)
-            
-            api = Api(function=func, spec=spec, use_doc_str=use_doc_str)
-            self._apis[func.__name__] = api
+            api = Api(function=func, spec=spec, use_doc_str=use_doc_str, name=name, validate_kwargs=validate_kwargs,
+                      dedupe=dedupe)
+            self._apis[api.name] = api
+
+            # The identify prompt documents every API so it's rebuilt on the next query
+            self._api_prompts = []
+            self._answer_prompts_cache.clear()
 
-            return wrapped_func
+            return func
         
         return registered_function
         
@@ -152,40 +296,65 @@ class AiApi():
             None
         """
             
-        api_list="\n".join(self._apis.keys()),
-        api_documentation="\n".join([i.formatted_documentation for i in self._apis.values()])
-
-        prompts = []
-        system_prompt = f"""
-        Your job is to identify APIs that need to be called to answer a user query.
-        You MUST ONLY reply in JSON format. DO not include additional text in your reply.
-        You will be given a list of APIs to choose from any you must identify what APIs you need to call and what arguments to pass to them.
-        You ONLY reply with JSON formatted text that includes the API name and the kwargs to pass to it. Below is an example:
-
-        Example:
-        {{
-            "apis": [
-                {{"name": "api_name", "kwargs": {{"arg1": "value1", "arg2": "value2"}}
-            ],
-            "notes": "Additional notes go here if needed"
-        }}
-
-        List of APIs:
-        {api_list}
-
-        Documentation for each API are as follows:
-        
-        {api_documentation}
-        """.replace('        ', '')
+        self._store_api_prompts(_build_api_prompts(*self._api_prompt_docs()))
 
-        prompts.append({'role': 'system', 'content': system_prompt})  
-                
+    async def _set_apis_prompt_async(self):
+        '''
+        Same as _set_apis_prompt but builds the prompts with the prompt executor when one was given,
+        so building the prompts for a large number of APIs doesn't block the event loop
+        '''
+
+        if self.prompt_executor is None:
+            return self._set_apis_prompt()
+
+        loop = asyncio.get_running_loop()
+        prompts = await loop.run_in_executor(self.prompt_executor, _build_api_prompts, *self._api_prompt_docs())
+        self._store_api_prompts(prompts)
+
+    def _api_prompt_docs(self) -> tuple:
+        cache_control = {'type': 'ephemeral'} if self.cache_api_docs else None
+        return list(self._apis), [i.formatted_documentation for i in self._apis.values()], cache_control
+
+    def _store_api_prompts(self, prompts: list):
         self._api_prompts = prompts
+        self._prompt_version = hashlib.blake2b(json.dumps(prompts, sort_keys=True).encode()).hexdigest()[:16]
+
+        # Describes the shape of an identify result calling only registered APIs. Sent without strict
+        # mode, which requires every object to list all of its properties, so it's not enforced exactly
+        self._identify_response_format = {
+            'type': 'json_schema',
+            'json_schema': {
+                'name': 'api_calls',
+                'schema': {
+                    'type': 'object',
+                    'properties': {
+                        'apis': {
+                            'type': 'array',
+                            'items': {
+                                'type': 'object',
+                                'properties': {
+                                    'name': {'type': 'string', 'enum': list(self._apis)},
+                                    'kwargs': {'type': 'object'}
+                                },
+                                'required': ['name', 'kwargs']
+                            }
+                        },
+                        'notes': {'type': 'string'}
+                    },
+                    'required': ['apis']
+                }
+            }
+        }
+
+        # Unlike the exact cache the semantic cache isn't keyed by the prompt version
+        if self._semantic_cache is not None:
+            self._semantic_cache.clear()
 
     def _generate_answer_prompts(self, apis_used: list) -> list:
         '''
         Generates the prompts that describe the APIs used along with examples in the JSON
-        format that the AI should expect the data in.
+        format that the AI should expect the data in. Prompts are cached by the set of APIs used,
+        so the returned list must not be modified.
 
         Args:
             apis_used (list): A subset of the APIs that were used in this query
@@ -193,26 +362,21 @@ class AiApi():
         Returns:
             list of prompts including the system and a 1 shot example
         '''
-        
-        api_documentation = "\n".join(self._apis[i].formatted_documentation for i in apis_used)
 
-        prompts = []
-        system_prompt = f"""
-        You are an assistant that answers a user query using supplemenal API informatin.
-        Results include the api used, the arguments passed to it, and the results of the call.
-        Answer the question as best you can with this information.
-        DO NOT reference the APIs that were used in the response.
+        apis_used_key = frozenset(apis_used)
+        if (prompts := self._answer_prompts_cache.get(apis_used_key)) is not None:
+            return prompts
+        
+        api_documentation = "\n".join(self._apis[i].formatted_documentation for i in sorted(apis_used_key))
 
-        Below is a description of the APIs used and how to interpret their results:
-        {api_documentation}
-        """.replace('        ', '')
+        prompts = [{'role': 'system', 'content': _ANSWER_SYSTEM_PROMPT.format(api_documentation=api_documentation)}]
 
-        prompts.append({'role': 'system', 'content': system_prompt})
+        self._answer_prompts_cache[apis_used_key] = prompts
             
         return prompts
     
 
-    def identify_apis(self, query: str) -> dict:
+    async def identify_apis_async(self, query: str) -> dict:
         '''
         Identifies the APIs that need to be called to answer the query
 
@@ -223,62 +387,198 @@ class AiApi():
             dict: The APIs that need to be called and their arguments
         '''
         
+        cache_key, embedding, api_calls = await self._get_cached_api_calls(query)
+        if api_calls is not None:
+            return api_calls
+
+        api_calls = await self._identify_batcher.submit(query)
+        self._cache_api_calls(cache_key, api_calls, embedding)
+
+        return api_calls
+
+
+    async def identify_apis_stream_async(self, query: str, on_api_call: Callable) -> dict:
+        '''
+        Identifies the APIs that need to be called to answer the query, streaming the AI's response
+        and calling on_api_call with each API call as soon as it has been fully generated.
+
+        Args:
+            query (str): The query to be answered
+            on_api_call (Callable): Called with each {"name": ..., "kwargs": ...} dict in order
+
+        Returns:
+            dict: The APIs that need to be called and their arguments
+        '''
+
+        cache_key, embedding, api_calls = await self._get_cached_api_calls(query)
+        if api_calls is not None:
+            for api_dict in api_calls['apis']:
+                on_api_call(api_dict)
+            return api_calls
+
+        self._use_http_session()
+        api_response = await openai.ChatCompletion.acreate(**self._identify_request(query), stream=True)
+
+        parser = ApiCallStreamParser()
+        async for chunk in api_response:
+            if content := chunk['choices'][0]['delta'].get('content'):
+                for api_dict in parser.feed(content):
+                    on_api_call(api_dict)
+
+        api_calls = self._parse_api_calls(parser.text)
+        self._cache_api_calls(cache_key, api_calls, embedding)
+
+        return api_calls
+
+
+    async def _get_cached_api_calls(self, query: str) -> tuple:
+        '''
+        Looks up the API calls for a query, first by the exact query and then by the query's
+        embedding when semantic caching is enabled
+
+        Returns:
+            tuple: The cache key, the query's embedding (None without semantic caching) and
+                the cached API calls (None on a miss)
+        '''
+
         if not self._api_prompts:
-            self._set_apis_prompt()
+            await self._set_apis_prompt_async()
+
+        cache_key = (self.model, self._prompt_version, query)
+        with self._identify_cache_lock:
+            api_calls = self._identify_cache.get(cache_key)
+            if api_calls is not None:
+                self._identify_cache.move_to_end(cache_key)
+
+        if api_calls is not None:
+            logger.debug(f"Using cached APIs for query: {query}")
+            return cache_key, None, copy.deepcopy(api_calls)
+
+        if self._semantic_cache is None:
+            return cache_key, None, None
+
+        self._use_http_session()
+        embedding_response = await openai.Embedding.acreate(input=[query], model=self.embedding_model)
+        embedding = embedding_response['data'][0]['embedding']
+
+        if (cached := self._semantic_cache.get(embedding)) is not None and cached[0] == self.model:
+            logger.debug(f"Using cached APIs for a similar query: {query}")
+            return cache_key, embedding, copy.deepcopy(cached[1])
+
+        return cache_key, embedding, None
+
+
+    def _cache_api_calls(self, cache_key: tuple, api_calls: dict, embedding: list = None):
+        if self.identify_cache_size:
+            api_calls_copy = copy.deepcopy(api_calls)
+            with self._identify_cache_lock:
+                self._identify_cache[cache_key] = api_calls_copy
+                if len(self._identify_cache) > self.identify_cache_size:
+                    self._identify_cache.popitem(last=False)
+
+        if embedding is not None:
+            self._semantic_cache.set(embedding, (self.model, copy.deepcopy(api_calls)))
 
-        query_prompt = [{
+
+    def _identify_request(self, query: str) -> dict:
+        '''
+        The chat completion parameters for identifying the APIs to call for a query
+        '''
+
+        request = {
+            'model': self.model,
+            'messages': self._identify_messages(query),
+            'temperature': self.api_temperature
+        }
+
+        if self.structured_output:
+            request['response_format'] = self._identify_response_format
+        elif self.json_mode:
+            request['response_format'] = {'type': 'json_object'}
+
+        if self.identify_max_tokens:
+            request['max_tokens'] = self.identify_max_tokens
+
+        return request
+
+
+    def _identify_messages(self, query: str) -> list:
+        query_prompt = {
             'role': 'user',
             'content': self.template_prompt_api_identify.format(query)
-            }
-        ]
+        }
+        messages = [*self._api_prompts, query_prompt]
         
-        for i in (self._api_prompts + query_prompt):
-            logger.debug(i['content'])
+        logger.opt(lazy=True).debug("{}", lambda: "\n".join(str(i['content']) for i in messages))
 
-        api_response = openai.ChatCompletion.create(
-            model=self.model,
-            messages=(self._api_prompts + query_prompt),
-            temperature=self.api_temperature
-        )
+        return messages
 
-        api_json_text = api_response.choices[0]['message']['content']
-        
+
+    def _parse_api_calls(self, api_json_text: str) -> dict:
         try:
             logger.debug(api_json_text)
-            api_calls = json.loads(api_json_text)
+            return _json_loads(api_json_text)
         except json.decoder.JSONDecodeError:
             logger.exception("Error decoding JSON")
             raise
 
-        return api_calls
+
+    async def _request_api_calls(self, query: str) -> dict:
+        '''
+        Asks the AI what APIs need to be called to answer a single query
+
+        Args:
+            query (str): The query to be answered
+
+        Returns:
+            dict: The APIs that need to be called and their arguments
+        '''
+
+        self._use_http_session()
+        api_response = await openai.ChatCompletion.acreate(**self._identify_request(query))
+
+        return self._parse_api_calls(api_response.choices[0]['message']['content'])
+
+
+    async def _request_api_calls_batch(self, queries: list) -> list:
+        '''
+        Identifies the APIs for a batch of queries concurrently. Failed queries have
+        their exception returned in place of the result.
+        '''
+
+        return await asyncio.gather(*(self._request_api_calls(q) for q in queries), return_exceptions=True)
+
+
+    def identify_apis(self, query: str) -> dict:
+        '''
+        Synchronous wrapper around identify_apis_async
+        '''
+
+        return asyncio.run(self._closing_http_session(self.identify_apis_async(query)))
     
 
-    def answer_query(self, api_results: dict) -> str:
+    async def answer_query_async(self, api_results: dict, answer_prompts: list = None) -> str:
         '''
         Answers the query based on the APIs that were called
 
         Args:
-            api_calls (dict): The APIs that need to be called and their arguments
+            api_results (dict): The user request and the results of each API called
+            answer_prompts (list): Optional system prompts for the APIs used, generated
+                from the api_results when not given
 
         Returns:
             str: The response to the query
         '''
 
-        apis_used = set(x for x in (i['name'] for i in api_results['apis']))
-        answer_prompts = self._generate_answer_prompts(apis_used)
-
-        answer_prompt = [{
-            'role': 'user',
-            'content': json.dumps(api_results)
-        }]
-        
-        for i in (answer_prompts + answer_prompt):
-            logger.debug(i['content'])
+        if answer_prompts is None:
+            apis_used = {i['name'] for i in api_results['apis']}
+            answer_prompts = self._generate_answer_prompts(apis_used)
         
+        self._use_http_session()
         try:
-            answer_response = openai.ChatCompletion.create(
+            answer_response = await openai.ChatCompletion.acreate(
                 model=self.model,
-                messages=(answer_prompts + answer_prompt),
+                messages=self._answer_messages(api_results, answer_prompts),
                 temperature=self.answer_temperature
             )
 
@@ -290,9 +590,71 @@ class AiApi():
         return answer_text
 
 
-    def run_function(self, function: Callable, kwargs: dict) -> Any:
+    def _answer_messages(self, api_results: dict, answer_prompts: list) -> list:
+        answer_prompt = {
+            'role': 'user',
+            'content': _json_dumps(api_results)
+        }
+        messages = [*answer_prompts, answer_prompt]
+        
+        logger.opt(lazy=True).debug("{}", lambda: "\n".join(str(i['content']) for i in messages))
+
+        return messages
+
+
+    def answer_query(self, api_results: dict) -> str:
+        '''
+        Synchronous wrapper around answer_query_async
         '''
-        Runs a function with the given kwargs
+
+        return asyncio.run(self._closing_http_session(self.answer_query_async(api_results)))
+
+
+    def _use_http_session(self):
+        '''
+        Points the openai client at the pooled aiohttp session for the running event loop so
+        requests reuse keepalive connections. A session set by the caller through openai.aiosession
+        is left in place.
+        '''
+
+        loop = asyncio.get_running_loop()
+        session = self._http_sessions.get(loop)
+
+        # Once aclose has been called the closed session is left behind in the context
+        current = openai.aiosession.get(None)
+        closed = isinstance(current, aiohttp.ClientSession) and current.closed
+        if current is not None and current is not session and not closed:
+            return
+
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=100, limit_per_host=20))
+            self._http_sessions[loop] = session
+
+        openai.aiosession.set(session)
+
+
+    async def aclose(self):
+        '''
+        Closes the pooled HTTP session for the running event loop. Call this before the loop ends
+        when using the async methods directly, the sync methods close it themselves
+        '''
+
+        session = self._http_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.close()
+
+
+    async def _closing_http_session(self, coro):
+        try:
+            return await coro
+        finally:
+            await self.aclose()
+
+
+    async def run_function(self, function: Callable, kwargs: dict) -> Any:
+        '''
+        Runs a function with the given kwargs. Coroutine functions are awaited directly while
+        regular functions are run in the worker thread pool so they don't block the event loop.
 
         Args:
             function (Callable): The function to be run
@@ -302,36 +664,265 @@ class AiApi():
             Any: The result of the function
         '''
 
-        return function(**kwargs)
+        if inspect.iscoroutinefunction(function):
+            return await function(**kwargs)
+
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.api_workers,
+                thread_name_prefix='ai_api'
+            )
+
+        # Same as asyncio.to_thread but on an executor that outlives each asyncio.run
+        context = contextvars.copy_context()
+        call = functools.partial(context.run, function, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, call)
     
 
-    def execute_query(self, query:str) -> str:
+    async def execute_query_async(self, query:str) -> str:
         '''
         Orchestrates the entire query process below:
         1. Use AI to identify what APIs need to be called
-        2. Executing the functions with the corresponding arguments
+        2. Executing the functions concurrently with the corresponding arguments
         3. Pass back the results to the AI to execute
         '''
 
-        api_calls = self.identify_apis(query)
-
-        api_results = []
-        for api_dict in api_calls['apis']:
+        # Identical calls to APIs registered with dedupe are only run once and share their result
+        call_keys = []
+        tasks = {}
 
-            api = self._apis[api_dict['name']]
+        def dispatch(api_dict):
+            call_keys.append(self._start_api_call(api_dict, tasks))
 
-            result = self.run_function(api.function, api_dict['kwargs'])
+        try:
+            if self.stream_identify:
+                # API calls start running while the AI is still generating the rest of its response
+                api_calls = await self.identify_apis_stream_async(query, dispatch)
+            else:
+                api_calls = await self.identify_apis_async(query)
+                for api_dict in api_calls['apis']:
+                    dispatch(api_dict)
+
+            # Let the API calls get dispatched before building the answer prompts so the
+            # prompt generation overlaps with the API calls instead of running after them
+            await asyncio.sleep(0)
+            apis_used = {i['name'] for i in api_calls['apis']}
+            answer_prompts = self._generate_answer_prompts(apis_used)
+
+            await asyncio.gather(*tasks.values())
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
 
-            api_results.append({
-                'name': api_dict['name'],
-                'kwargs': api_dict['kwargs'],
-                'result': result
-            })
+        api_results = self._api_results(api_calls, call_keys, tasks)
         
         query_and_api_results = {'user_request': query, 'apis': api_results}
 
-        answer = self.answer_query(query_and_api_results)
+        answer = await self.answer_query_async(query_and_api_results, answer_prompts)
         return answer
+
+
+    def _start_api_call(self, api_dict: dict, tasks: dict) -> tuple:
+        '''
+        Schedules a call to an API unless the API was registered with dedupe and an identical call
+        is already in tasks
+
+        Args:
+            api_dict (dict): The name of the API and the kwargs to call it with
+            tasks (dict): The calls scheduled so far, keyed by name and kwargs
+
+        Returns:
+            tuple: The key of the call in tasks
+        '''
+
+        api = self._apis[api_dict['name']]
+        if api.dedupe:
+            key = (api.name, json.dumps(api_dict['kwargs'], sort_keys=True))
+            if key in tasks:
+                return key
+        else:
+            key = (api.name, len(tasks))
+
+        tasks[key] = asyncio.ensure_future(self.run_function(api.function, api.validate_kwargs(api_dict['kwargs'])))
+
+        return key
+
+
+    def _api_results(self, api_calls: dict, call_keys: list, tasks: dict) -> list:
+        return [{
+                'name': api_dict['name'],
+                'kwargs': api_dict['kwargs'],
+                'result': tasks[key].result()
+            } for api_dict, key in zip(api_calls['apis'], call_keys)
+        ]
+
+
+    def execute_query(self, query:str) -> str:
+        '''
+        Synchronous wrapper around execute_query_async. Use execute_query_async directly
+        when already running inside an event loop.
+        '''
+
+        return asyncio.run(self._closing_http_session(self.execute_query_async(query)))
+
+
+    async def execute_queries_async(self, queries: list) -> list:
+        '''
+        Answers several queries concurrently, overlapping their requests to the AI and their API calls
+
+        Args:
+            queries (list): The queries to be answered
+
+        Returns:
+            list: The response to each query, in the same order as the queries
+        '''
+
+        return await asyncio.gather(*(self.execute_query_async(query) for query in queries))
+
+
+    async def _run_openai_batch(self, bodies: dict, completion_window: str) -> dict:
+        '''
+        Runs chat completions through the OpenAI Batch API and waits for them to finish. The
+        status is polled with exponential backoff so small batches are picked up in seconds
+        without polling a long running batch every second.
+
+        Args:
+            bodies (dict): The chat completion request bodies keyed by a custom id
+            completion_window (str): The time frame the batch must be processed within
+
+        Returns:
+            dict: The chat completion response bodies keyed by the same custom ids
+        '''
+
+        batch_lines = "\n".join(_json_dumps({
+                'custom_id': custom_id,
+                'method': 'POST',
+                'url': '/v1/chat/completions',
+                'body': body
+            }) for custom_id, body in bodies.items()
+        )
+
+        self._use_http_session()
+        batch_file = await openai.File.acreate(
+            file=io.BytesIO(batch_lines.encode()),
+            purpose='batch',
+            user_provided_filename='ai_api_batch.jsonl'
+        )
+
+        requestor = openai.api_requestor.APIRequestor()
+        response, _, _ = await requestor.arequest('post', '/batches', params={
+            'input_file_id': batch_file['id'],
+            'endpoint': '/v1/chat/completions',
+            'completion_window': completion_window
+        })
+        batch = response.data
+
+        poll_interval = _BATCH_POLL_MIN
+        while batch['status'] not in ('completed', 'failed', 'expired', 'cancelled'):
+            logger.debug(f"Batch {batch['id']} is {batch['status']}")
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, _BATCH_POLL_MAX)
+            response, _, _ = await requestor.arequest('get', f"/batches/{batch['id']}")
+            batch = response.data
+
+        if batch['status'] != 'completed':
+            raise openai.error.OpenAIError(f"Batch {batch['id']} {batch['status']}")
+
+        # No output file is written when every request in the batch failed
+        if batch.get('output_file_id') is None:
+            raise openai.error.OpenAIError(f"Batch {batch['id']} failed for every request, see {batch.get('error_file_id')}")
+
+        # File.adownload in openai 0.27 returns the unread aiohttp stream rather than the bytes
+        output = await asyncio.to_thread(openai.File.download, batch['output_file_id'])
+
+        results = {}
+        for line in output.splitlines():
+            result = _json_loads(line)
+            response = result.get('response')
+            if response is not None and response['status_code'] == 200:
+                results[result['custom_id']] = response['body']
+
+        if missing := bodies.keys() - results.keys():
+            raise openai.error.OpenAIError(f"Batch {batch['id']} failed for requests {sorted(missing)}")
+
+        return results
+
+
+    async def _execute_queries_batch(self, queries: list, completion_window: str) -> list:
+        # Identify the APIs for every query that isn't cached in a single batch
+        lookups = await asyncio.gather(*(self._get_cached_api_calls(query) for query in queries))
+        api_calls_by_query = [api_calls for _, _, api_calls in lookups]
+
+        identify_bodies = {
+            str(i): self._identify_request(query)
+            for i, (query, api_calls) in enumerate(zip(queries, api_calls_by_query)) if api_calls is None
+        }
+        if identify_bodies:
+            responses = await self._run_openai_batch(identify_bodies, completion_window)
+            for custom_id, body in responses.items():
+                i = int(custom_id)
+                api_calls_by_query[i] = self._parse_api_calls(body['choices'][0]['message']['content'])
+                self._cache_api_calls(lookups[i][0], api_calls_by_query[i], lookups[i][1])
+
+        # Each query gets its own calls, identical calls are only shared within a query for APIs with dedupe
+        tasks_by_query = [{} for _ in queries]
+
+        def all_tasks():
+            return [task for tasks in tasks_by_query for task in tasks.values()]
+
+        try:
+            call_keys_by_query = [
+                [self._start_api_call(api_dict, tasks) for api_dict in api_calls['apis']]
+                for api_calls, tasks in zip(api_calls_by_query, tasks_by_query)
+            ]
+            await asyncio.gather(*all_tasks())
+        except BaseException:
+            for task in all_tasks():
+                task.cancel()
+            raise
+
+        # Answer every query in a second batch
+        answer_bodies = {}
+        for i, (query, api_calls, call_keys, tasks) in enumerate(
+                zip(queries, api_calls_by_query, call_keys_by_query, tasks_by_query)):
+            query_and_api_results = {'user_request': query, 'apis': self._api_results(api_calls, call_keys, tasks)}
+            answer_prompts = self._generate_answer_prompts({api_dict['name'] for api_dict in api_calls['apis']})
+
+            answer_bodies[str(i)] = {
+                'model': self.model,
+                'messages': self._answer_messages(query_and_api_results, answer_prompts),
+                'temperature': self.answer_temperature
+            }
+
+        responses = await self._run_openai_batch(answer_bodies, completion_window)
+        return [responses[str(i)]['choices'][0]['message']['content'] for i in range(len(queries))]
+
+
+    def execute_queries(self, queries: list) -> list:
+        '''
+        Synchronous wrapper around execute_queries_async
+        '''
+
+        return asyncio.run(self._closing_http_session(self.execute_queries_async(queries)))
+
+
+    def execute_queries_batch(self, queries: list, completion_window: str = "24h") -> list:
+        '''
+        Answers a list of queries using the OpenAI Batch API, which costs half as much as regular
+        requests but can take up to the completion window. The APIs for all queries are identified
+        in one batch, the identified APIs are called concurrently and the answers are generated in
+        a second batch.
+
+        Args:
+            queries (list): The queries to be answered
+            completion_window (str): The time frame each batch must be processed within
+
+        Returns:
+            list: The response to each query, in the same order as the queries
+        '''
+
+        return asyncio.run(self._closing_http_session(self._execute_queries_batch(queries, completion_window)))
  
                 
 class Api():
@@ -343,13 +934,55 @@ class Api():
     name: str
     function: Callable
     spec: ApiSpec
+    dedupe: bool
     formatted_spec_doc: str
 
-    def __init__(self, function: Callable, use_doc_str: bool, spec: ApiSpec):
+    def __init__(self, function: Callable, use_doc_str: bool, spec: ApiSpec, name: str = None, validate_kwargs: bool = False,
+                 dedupe: bool = False):
         self.spec = spec
-        self.name = function.__name__
+        self.dedupe = dedupe
+        self.name = name or function.__name__
         self.function = function
         self.formatted_documentation = self._create_api_documentation(self.spec)
+        self._kwargs_model = self._create_kwargs_model() if validate_kwargs else None
+
+    def _create_kwargs_model(self) -> type:
+        '''
+        Builds a pydantic model of the function's parameters once so the kwargs for each call can be
+        validated without inspecting the function again. Parameters without a type hint accept anything.
+        '''
+
+        # Parameters are aliases of generated field names, parameter names like json or _private
+        # would otherwise shadow BaseModel attributes or be dropped as private
+        fields = {}
+        self._kwargs_names = {}
+        extra = Extra.forbid
+        for param in inspect.signature(self.function).parameters.values():
+            if param.kind == param.VAR_KEYWORD:
+                extra = Extra.allow
+            elif param.kind != param.VAR_POSITIONAL:
+                annotation = Any if param.annotation is param.empty else param.annotation
+                default = ... if param.default is param.empty else param.default
+                field_name = f'field_{len(fields)}'
+                fields[field_name] = (annotation, Field(default, alias=param.name))
+                self._kwargs_names[field_name] = param.name
+
+        config = type('Config', (), {'extra': extra, 'arbitrary_types_allowed': True})
+        return create_model(f'{self.name}_kwargs', __config__=config, **fields)
+
+    def validate_kwargs(self, kwargs: dict) -> dict:
+        '''
+        Validates and coerces the kwargs the AI chose for this API when kwargs validation is enabled
+
+        Raises:
+            pydantic.ValidationError: The kwargs don't match the function's parameters
+        '''
+
+        if self._kwargs_model is None:
+            return kwargs
+
+        # Extra kwargs, allowed when the function takes **kwargs, keep their own names
+        return {self._kwargs_names.get(k, k): v for k, v in self._kwargs_model(**kwargs)}
 
     def _create_api_documentation(self, spec: dict, use_doc_str=True) -> str:
         '''
@@ -357,10 +990,225 @@ class Api():
         injected into the api and answer prompts to inform the AI how to use the API
         '''
 
-        template = f'''
-        Python Function Name: {self.function.__name__}
-        Python Documentation:
-        {self.function.__doc__}
+        template = (
+            f"\nPython Function Name: {self.name}"
+            "\nPython Documentation:"
+            f"\n{inspect.getdoc(self.function)}\n"
+        )
+
+        return template
+
+
+class AsyncBatcher():
+    '''
+    Groups items submitted concurrently on the same event loop into batches that are processed with
+    a single call to the batch function. A batch is flushed once it has max_batch items or max_wait_ms
+    has passed since its first item; with max_wait_ms=0 only items already queued are grouped.
+    Identical items in a batch are only processed once and each of their submitters gets its own copy
+    of the result.
+    '''
+
+    def __init__(self, batch_function: Callable, max_batch: int = 16, max_wait_ms: float = 0):
+        '''
+        Args:
+            batch_function (Callable): Coroutine function taking a list of items and returning a list of
+                results in the same order. A result that is an exception is raised to its submitter.
+            max_batch (int): The maximum number of items in a batch
+            max_wait_ms (float): How long to wait for more items after the first one is submitted
+        '''
+
+        self._batch_function = batch_function
+        self.max_batch = max_batch
+        self.max_wait_ms = max_wait_ms
+
+        # Queues and tasks are bound to a loop and each asyncio.run creates a new one, possibly on
+        # several threads at once, so every loop gets its own queue and worker
+        self._workers = weakref.WeakKeyDictionary()
+        # The loop only keeps weak references to tasks so running batches are held here until they finish
+        self._batch_tasks = set()
+
+    async def submit(self, item: Any) -> Any:
+        '''
+        Adds an item to the next batch and waits for its result
+        '''
+
+        loop = asyncio.get_running_loop()
+        queue, worker = self._workers.get(loop, (None, None))
+        if worker is None or worker.done():
+            queue = asyncio.Queue()
+            worker = loop.create_task(self._collect_batches(queue))
+            self._workers[loop] = (queue, worker)
+            # The worker is cancelled when asyncio.run finishes, its entry would otherwise keep the loop alive
+            worker.add_done_callback(functools.partial(self._remove_worker, loop))
+
+        future = loop.create_future()
+        queue.put_nowait((item, future))
+        return await future
+
+    def _remove_worker(self, loop: asyncio.AbstractEventLoop, worker: asyncio.Task):
+        if self._workers.get(loop, (None, None))[1] is worker:
+            del self._workers[loop]
+
+    async def _collect_batches(self, queue: asyncio.Queue):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + self.max_wait_ms / 1000
+
+            while len(batch) < self.max_batch:
+                if not queue.empty():
+                    batch.append(queue.get_nowait())
+                    continue
+
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            task = loop.create_task(self._process_batch(batch))
+            self._batch_tasks.add(task)
+            task.add_done_callback(self._batch_tasks.discard)
+
+    async def _process_batch(self, batch: list):
+        futures_by_item = {}
+        for item, future in batch:
+            futures_by_item.setdefault(item, []).append(future)
+
+        items = list(futures_by_item)
+        try:
+            results = await self._batch_function(items)
+        except Exception as e:
+            results = [e] * len(items)
+
+        for item, result in zip(items, results):
+            for i, future in enumerate(futures_by_item[item]):
+                if future.done():
+                    continue
+                elif isinstance(result, BaseException):
+                    future.set_exception(result)
+                else:
+                    # Copied so one submitter changing its result can't change another's
+                    future.set_result(result if i == 0 else copy.deepcopy(result))
+
+
+class ApiCallStreamParser():
+    '''
+    Incrementally parses the identify response as it is streamed from the AI, returning each entry of
+    the "apis" list as soon as its JSON object is complete.
+    '''
+
+    _apis_start = re.compile(r'"apis"\s*:\s*\[')
+    _decoder = json.JSONDecoder()
+
+    def __init__(self):
+        self.text = ''
+        self._pos = None
+        self._done = False
+
+    def feed(self, content: str) -> list:
+        '''
+        Adds the next piece of the response and returns the API calls completed by it
+        '''
+
+        self.text += content
+        api_calls = []
+
+        if self._pos is None:
+            if not (match := self._apis_start.search(self.text)):
+                return api_calls
+            self._pos = match.end()
+
+        while not self._done:
+            while self._pos < len(self.text) and self.text[self._pos] in ' \t\r\n,':
+                self._pos += 1
+
+            if self._pos == len(self.text):
+                break
+            elif self.text[self._pos] == ']':
+                self._done = True
+                break
+
+            try:
+                api_call, self._pos = self._decoder.raw_decode(self.text, self._pos)
+            except json.JSONDecodeError:
+                # The object hasn't been fully streamed yet
+                break
+
+            api_calls.append(api_call)
+
+        return api_calls
+
+
+class SemanticCache():
+    '''
+    LRU cache of values keyed by embedding vectors. A lookup returns the value of the most similar
+    cached embedding when its cosine similarity is at least the threshold. Uses numpy when it is
+    installed.
+    '''
+
+    def __init__(self, max_size: int = 256, threshold: float = .93):
+        self.max_size = max_size
+        self.threshold = threshold
+
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._matrix = None
+        # Shared by the threads calling AiApi's sync methods
+        self._lock = threading.Lock()
+
+    def get(self, embedding: list) -> Any:
+        '''
+        Returns the value cached for the most similar embedding or None if nothing is similar enough
         '''
 
-        return template
\ No newline at end of file
+        query = self._normalize(embedding)
+        with self._lock:
+            return self._get(query)
+
+    def _get(self, query: list) -> Any:
+        if not self._entries:
+            return None
+
+        if np is not None:
+            if self._matrix is None:
+                self._matrix = (list(self._entries), np.array([v for v, _ in self._entries.values()]))
+            ids, matrix = self._matrix
+            similarities = matrix @ np.asarray(query)
+            best = int(similarities.argmax())
+            entry_id, similarity = ids[best], similarities[best]
+        else:
+            entry_id, similarity = max(
+                ((i, sum(a * b for a, b in zip(vector, query))) for i, (vector, _) in self._entries.items()),
+                key=lambda x: x[1]
+            )
+
+        if similarity < self.threshold:
+            return None
+
+        self._entries.move_to_end(entry_id)
+        return self._entries[entry_id][1]
+
+    def set(self, embedding: list, value: Any):
+        vector = self._normalize(embedding)
+        with self._lock:
+            self._entries[self._next_id] = (vector, value)
+            self._next_id += 1
+            self._matrix = None
+
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._matrix = None
+
+    @staticmethod
+    def _normalize(embedding: list) -> list:
+        norm = sum(x * x for x in embedding) ** .5 or 1
+        return [x / norm for x in embedding]
@@ -1,9 +1,16 @@
 import json
 import pytest
+import aiohttp
+import openai
+import asyncio
+import threading
 import datetime
+import contextvars
+import concurrent.futures
 
-from unittest.mock import MagicMock
-from ai_api import AiApi
+from unittest.mock import MagicMock, AsyncMock
+from pydantic import ValidationError
+from ai_api import AiApi, ApiSpec, ApiCallStreamParser, SemanticCache
 from example_api_dict import example1
 
 
@@ -56,17 +63,186 @@ class TestAiApi:
 
         mock_openai = MagicMock()
         monkeypatch.setattr('ai_api.openai', mock_openai)
-        mock_openai.ChatCompletion.create.return_value.choices = [{'message': {'content': json.dumps(expected_api_calls)}}]
+        mock_openai.ChatCompletion.acreate = AsyncMock()
+        mock_openai.ChatCompletion.acreate.return_value.choices = [{'message': {'content': json.dumps(expected_api_calls)}}]
 
         api_calls = ai_api.identify_apis(query)
         assert api_calls == expected_api_calls
 
+    def test_identify_apis_structured_output(self, monkeypatch):
+        api = AiApi(model='gpt-4o', structured_output=True)
+
+        @api.register_api()
+        def get_answer(question: str):
+            '''Returns the answer to the question'''
+
+        api_calls = {"apis": [{'name': 'get_answer', 'kwargs': {'question': 'life'}}]}
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.ChatCompletion.acreate = AsyncMock()
+        mock_openai.ChatCompletion.acreate.return_value.choices = [{'message': {'content': json.dumps(api_calls)}}]
+
+        assert api.identify_apis('What is the answer?') == api_calls
+
+        response_format = mock_openai.ChatCompletion.acreate.call_args.kwargs['response_format']
+        assert response_format['type'] == 'json_schema'
+        api_schema = response_format['json_schema']['schema']['properties']['apis']['items']
+        assert api_schema['properties']['name']['enum'] == ['get_answer']
+
+    def test_identify_apis_json_mode(self, monkeypatch):
+        api = AiApi(json_mode=True, identify_max_tokens=256)
+
+        @api.register_api()
+        def get_answer(question: str):
+            '''Returns the answer to the question'''
+
+        api_calls = {"apis": [{'name': 'get_answer', 'kwargs': {'question': 'life'}}]}
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.ChatCompletion.acreate = AsyncMock()
+        mock_openai.ChatCompletion.acreate.return_value.choices = [{'message': {'content': json.dumps(api_calls)}}]
+
+        assert api.identify_apis('What is the answer?') == api_calls
+
+        request = mock_openai.ChatCompletion.acreate.call_args.kwargs
+        assert request['response_format'] == {'type': 'json_object'}
+        assert request['max_tokens'] == 256
+
+    def test_identify_apis_cached(self, monkeypatch):
+        api = AiApi(identify_cache_size=1)
+
+        @api.register_api()
+        def get_answer(question: str):
+            '''Returns the answer to the question'''
+
+        api_calls = {"apis": [{'name': 'get_answer', 'kwargs': {'question': 'life'}}]}
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.ChatCompletion.acreate = AsyncMock()
+        mock_openai.ChatCompletion.acreate.return_value.choices = [{'message': {'content': json.dumps(api_calls)}}]
+
+        assert api.identify_apis('What is the answer?') == api_calls
+        assert api.identify_apis('What is the answer?') == api_calls
+        assert mock_openai.ChatCompletion.acreate.await_count == 1
+
+        # Evicted once the cache is full
+        api.identify_apis('What is the question?')
+        api.identify_apis('What is the answer?')
+        assert mock_openai.ChatCompletion.acreate.await_count == 3
+
+    def test_identify_apis_semantic_cache(self, monkeypatch):
+        api = AiApi(embedding_model='text-embedding-3-small')
+
+        @api.register_api()
+        def get_answer(question: str):
+            '''Returns the answer to the question'''
+
+        api_calls = {"apis": [{'name': 'get_answer', 'kwargs': {'question': 'life'}}]}
+        embeddings = {
+            'What is the answer?': [1, 0, 0],
+            'What is the answer??': [.99, .05, 0],
+            'What is the question?': [0, 1, 0]
+        }
+
+        async def create_embedding(input, model):
+            return {'data': [{'embedding': embeddings[input[0]]}]}
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.Embedding.acreate = AsyncMock(side_effect=create_embedding)
+        mock_openai.ChatCompletion.acreate = AsyncMock()
+        mock_openai.ChatCompletion.acreate.return_value.choices = [{'message': {'content': json.dumps(api_calls)}}]
+
+        assert api.identify_apis('What is the answer?') == api_calls
+        assert api.identify_apis('What is the answer??') == api_calls
+        assert mock_openai.ChatCompletion.acreate.await_count == 1
+
+        api.identify_apis('What is the question?')
+        assert mock_openai.ChatCompletion.acreate.await_count == 2
+
+    def test_semantic_cache_lru(self):
+        cache = SemanticCache(max_size=2, threshold=.9)
+        cache.set([1, 0], 'a')
+        cache.set([0, 1], 'b')
+
+        assert cache.get([2, 0.1]) == 'a'
+        assert cache.get([1, 1]) is None
+
+        cache.set([-1, 0], 'c')
+        assert cache.get([0, 1]) is None
+        assert cache.get([1, 0]) == 'a'
+
+    def test_identify_apis_batched(self, monkeypatch):
+        api = AiApi(identify_cache_size=0)
+
+        @api.register_api()
+        def get_answer(question: str):
+            '''Returns the answer to the question'''
+
+        api_calls = {"apis": [{'name': 'get_answer', 'kwargs': {'question': 'life'}}]}
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.ChatCompletion.acreate = AsyncMock()
+        mock_openai.ChatCompletion.acreate.return_value.choices = [{'message': {'content': json.dumps(api_calls)}}]
+
+        async def identify_concurrently():
+            return await asyncio.gather(
+                api.identify_apis_async('What is the answer?'),
+                api.identify_apis_async('What is the answer?'),
+                api.identify_apis_async('What is the question?')
+            )
+
+        results = asyncio.run(identify_concurrently())
+        assert results == [api_calls] * 3
+        assert results[0] is not results[1]
+        assert mock_openai.ChatCompletion.acreate.await_count == 2
+
+    @pytest.mark.parametrize('identify_cache_size', [0, 4])
+    def test_execute_query_threads(self, monkeypatch, identify_cache_size):
+        api = AiApi(identify_cache_size=identify_cache_size)
+
+        @api.register_api()
+        def get_answer(question: str):
+            '''Returns the answer to the question'''
+            return 42
+
+        async def create(**kwargs):
+            await asyncio.sleep(0.001)
+            content = kwargs['messages'][-1]['content']
+            if content.startswith('Identify'):
+                content = json.dumps({'apis': [{'name': 'get_answer', 'kwargs': {'question': content}}]})
+            else:
+                content = 'answer'
+            return MagicMock(choices=[{'message': {'content': content}}])
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.ChatCompletion.acreate = AsyncMock(side_effect=create)
+
+        # Each thread runs its own event loop while sharing the batcher and identify cache
+        results = []
+        def execute_query(i):
+            results.append(api.execute_query(f'Question {i % 16}?'))
+
+        threads = [threading.Thread(target=execute_query, args=(i,), daemon=True) for i in range(128)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+
+        assert not any(thread.is_alive() for thread in threads)
+        assert results == ['answer'] * 128
+
     def test_execute_query(self, ai_api, monkeypatch):
         query = 'Sample query for executing APIs'
         expected_answer = 'Expected answer for the sample query'
 
-        mock_identify_apis = MagicMock()
-        monkeypatch.setattr(ai_api, 'identify_apis', mock_identify_apis)
+        mock_identify_apis = AsyncMock()
+        monkeypatch.setattr(ai_api, 'identify_apis_async', mock_identify_apis)
         mock_identify_apis.return_value = {
             "apis": [
                 {
@@ -78,7 +254,8 @@ class TestAiApi:
 
         mock_openai = MagicMock()
         monkeypatch.setattr('ai_api.openai', mock_openai)
-        mock_openai.ChatCompletion.create.return_value.choices = [{'message': {'content': expected_answer}}]
+        mock_openai.ChatCompletion.acreate = AsyncMock()
+        mock_openai.ChatCompletion.acreate.return_value.choices = [{'message': {'content': expected_answer}}]
 
         answer = ai_api.execute_query(query)
         assert answer == expected_answer
@@ -89,6 +266,83 @@ class TestAiApi:
         for prompt in ai_api._api_prompts:
             assert prompt['role'] in ('user', 'assistant', 'system'), f"Invalid key {prompt['role']} in ai prompt keys"
 
+    def test_register_api_resets_prompts(self):
+        api = AiApi()
+
+        @api.register_api()
+        def first_api():
+            '''First API'''
+
+        api._set_apis_prompt()
+        assert 'first_api' in api._api_prompts[0]['content']
+
+        @api.register_api()
+        def second_api():
+            '''Second API'''
+
+        assert api._api_prompts == []
+
+        api._set_apis_prompt()
+        assert 'second_api' in api._api_prompts[0]['content']
+
+    def test_cache_api_docs(self):
+        api = AiApi(cache_api_docs=True)
+
+        @api.register_api()
+        def first_api():
+            '''First API'''
+
+        api._set_apis_prompt()
+        docs, instructions = api._api_prompts
+
+        assert docs['content'][0]['cache_control'] == {'type': 'ephemeral'}
+        assert 'first_api' in docs['content'][0]['text']
+        assert 'first_api' not in instructions['content']
+
+    def test_api_spec_validation(self):
+
+        assert ApiSpec(**example1).name == 'risk_decomposition'
+
+        with pytest.raises(ValidationError):
+            ApiSpec(**{**example1, 'example_query': []})
+
+        with pytest.raises(ValidationError):
+            ApiSpec(**{**example1, 'args': [('portfolio', 'list')]})
+
+        with pytest.raises(ValidationError):
+            ApiSpec(**{**example1, 'example_kwargs': ['portfolio']})
+
+        missing_name = dict(example1)
+        del missing_name['name']
+        with pytest.raises(ValidationError):
+            ApiSpec(**missing_name)
+
+    def test_set_apis_prompt_executor(self):
+        api = AiApi(prompt_executor=concurrent.futures.ProcessPoolExecutor(max_workers=1))
+
+        @api.register_api()
+        def first_api():
+            '''First API'''
+
+        with api.prompt_executor:
+            asyncio.run(api._set_apis_prompt_async())
+
+        prompts = api._api_prompts
+        api._set_apis_prompt()
+        assert prompts == api._api_prompts
+
+    def test_register_api_name(self):
+        api = AiApi()
+
+        @api.register_api(name='get_the_answer')
+        def get_answer():
+            '''Returns the answer'''
+            return 42
+
+        assert list(api._apis) == ['get_the_answer']
+        assert api._apis['get_the_answer'].function is get_answer
+        assert 'Python Function Name: get_the_answer' in api._apis['get_the_answer'].formatted_documentation
+
     def test_ai_function_keys(self, ai_api, monkeypatch):
 
         assert 'risk_decomposition' in ai_api._apis.keys()
@@ -110,8 +364,362 @@ class TestAiApi:
         api_response = ai_api._generate_answer_prompts(['risk_decomposition'])
         assert len(api_response[0]) == 2
             
+    def test_answer_prompts_cached(self, ai_api, monkeypatch):
+
+        api_response = ai_api._generate_answer_prompts(['risk_decomposition'])
+        assert ai_api._generate_answer_prompts({'risk_decomposition'}) is api_response
+
     def test_generate_answer_prompts_nonexistent_api(self, ai_api, monkeypatch):
 
         with pytest.raises(KeyError):
             ai_api._generate_answer_prompts(['nonexistent_api'])
-            
\ No newline at end of file
+            
+
+    def test_execute_query_async_function(self, monkeypatch):
+        api = AiApi()
+
+        @api.register_api()
+        async def get_answer(question: str):
+            '''
+            Returns the answer to the question
+            '''
+            return 42
+
+        mock_identify_apis = AsyncMock()
+        monkeypatch.setattr(api, 'identify_apis_async', mock_identify_apis)
+        mock_identify_apis.return_value = {
+            "apis": [
+                {'name': 'get_answer', 'kwargs': {'question': 'life'}},
+                {'name': 'get_answer', 'kwargs': {'question': 'universe'}}
+            ]
+        }
+
+        mock_answer_query = AsyncMock(return_value='42')
+        monkeypatch.setattr(api, 'answer_query_async', mock_answer_query)
+
+        assert api.execute_query('What is the answer?') == '42'
+
+        api_results = mock_answer_query.call_args[0][0]
+        assert [i['result'] for i in api_results['apis']] == [42, 42]
+        assert [i['kwargs']['question'] for i in api_results['apis']] == ['life', 'universe']
+
+    def test_execute_query_validate_kwargs(self, monkeypatch):
+        api = AiApi()
+
+        @api.register_api(validate_kwargs=True)
+        def days_until(date: datetime.date, offset: int = 0):
+            '''
+            Returns the number of days until the date
+            '''
+            return (date - datetime.date(2024, 1, 1)).days + offset
+
+        mock_identify_apis = AsyncMock()
+        monkeypatch.setattr(api, 'identify_apis_async', mock_identify_apis)
+        mock_identify_apis.return_value = {'apis': [{'name': 'days_until', 'kwargs': {'date': '2024-01-11', 'offset': '2'}}]}
+
+        mock_answer_query = AsyncMock(return_value='12')
+        monkeypatch.setattr(api, 'answer_query_async', mock_answer_query)
+
+        assert api.execute_query('How many days?') == '12'
+        assert mock_answer_query.call_args[0][0]['apis'][0]['result'] == 12
+
+        mock_identify_apis.return_value = {'apis': [{'name': 'days_until', 'kwargs': {'when': 'tomorrow'}}]}
+        with pytest.raises(ValidationError):
+            api.execute_query('How many days?')
+
+    def test_execute_query_shares_http_session(self, monkeypatch):
+        api = AiApi()
+
+        @api.register_api()
+        def get_answer(question: str):
+            '''Returns the answer to the question'''
+            return 42
+
+        sessions = []
+        replies = iter([json.dumps({'apis': [{'name': 'get_answer', 'kwargs': {'question': 'life'}}]}), '42'])
+
+        async def create(**kwargs):
+            sessions.append(mock_openai.aiosession.get())
+            return MagicMock(choices=[{'message': {'content': next(replies)}}])
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.aiosession = contextvars.ContextVar('aiosession', default=None)
+        mock_openai.ChatCompletion.acreate = AsyncMock(side_effect=create)
+
+        assert api.execute_query('What is the answer?') == '42'
+
+        assert len(sessions) == 2
+        assert isinstance(sessions[0], aiohttp.ClientSession)
+        assert sessions[0] is sessions[1]
+        assert sessions[0].closed
+
+    def test_validate_kwargs_parameter_names(self):
+        api = AiApi()
+
+        @api.register_api(validate_kwargs=True)
+        def dump(json: int, _indent: int = 2, **options):
+            '''Dumps the value'''
+
+        kwargs = api._apis['dump'].validate_kwargs({'json': '1', '_indent': '4', 'sort_keys': True})
+        assert kwargs == {'json': 1, '_indent': 4, 'sort_keys': True}
+
+        assert api._apis['dump'].validate_kwargs({'json': 1}) == {'json': 1, '_indent': 2}
+
+        with pytest.raises(ValidationError):
+            api._apis['dump'].validate_kwargs({'json': 'one'})
+
+    def test_run_function_thread_pool(self):
+        api = AiApi(api_workers=2)
+
+        def get_thread():
+            return threading.current_thread()
+
+        first = asyncio.run(api.run_function(get_thread, {}))
+        second = asyncio.run(api.run_function(get_thread, {}))
+
+        assert first.name.startswith('ai_api')
+        assert first is second
+
+    def test_log_handler_shared(self):
+        from loguru import logger
+
+        handlers = len(logger._core.handlers)
+        for _ in range(3):
+            AiApi(LOG_LEVEL="DEBUG")
+        AiApi(LOG_LEVEL="INFO")
+
+        assert len(logger._core.handlers) == handlers
+
+    def test_execute_query_deduplicates_calls(self, monkeypatch):
+        api = AiApi()
+        calls = []
+
+        @api.register_api(dedupe=True)
+        def get_answer(question: str, detail: int):
+            '''
+            Returns the answer to the question
+            '''
+            calls.append(question)
+            return 42
+
+        mock_identify_apis = AsyncMock()
+        monkeypatch.setattr(api, 'identify_apis_async', mock_identify_apis)
+        mock_identify_apis.return_value = {
+            "apis": [
+                {'name': 'get_answer', 'kwargs': {'question': 'life', 'detail': 1}},
+                {'name': 'get_answer', 'kwargs': {'detail': 1, 'question': 'life'}}
+            ]
+        }
+
+        mock_answer_query = AsyncMock(return_value='42')
+        monkeypatch.setattr(api, 'answer_query_async', mock_answer_query)
+
+        assert api.execute_query('What is the answer?') == '42'
+        assert calls == ['life']
+
+        api_results = mock_answer_query.call_args[0][0]
+        assert [i['result'] for i in api_results['apis']] == [42, 42]
+
+    def test_execute_query_runs_identical_calls(self, monkeypatch):
+        api = AiApi()
+        numbers = iter([7, 3])
+
+        @api.register_api()
+        def get_random_number(low: int, high: int):
+            '''
+            Returns a random number between low and high
+            '''
+            return next(numbers)
+
+        mock_identify_apis = AsyncMock()
+        monkeypatch.setattr(api, 'identify_apis_async', mock_identify_apis)
+        mock_identify_apis.return_value = {
+            "apis": [
+                {'name': 'get_random_number', 'kwargs': {'low': 1, 'high': 10}},
+                {'name': 'get_random_number', 'kwargs': {'low': 1, 'high': 10}}
+            ]
+        }
+
+        mock_answer_query = AsyncMock(return_value='7 and 3')
+        monkeypatch.setattr(api, 'answer_query_async', mock_answer_query)
+
+        assert api.execute_query('Give me two random numbers') == '7 and 3'
+
+        api_results = mock_answer_query.call_args[0][0]
+        assert sorted(i['result'] for i in api_results['apis']) == [3, 7]
+
+    def test_api_call_stream_parser(self):
+        api_calls = {
+            "apis": [
+                {'name': 'get_answer', 'kwargs': {'question': 'life [and] {everything}'}},
+                {'name': 'get_answer', 'kwargs': {'question': 'universe'}}
+            ],
+            "notes": "Two calls"
+        }
+        text = json.dumps(api_calls, indent=4)
+
+        parser = ApiCallStreamParser()
+        streamed = []
+        for i, char in enumerate(text):
+            for api_call in parser.feed(char):
+                streamed.append((i, api_call))
+
+        assert [api_call for _, api_call in streamed] == api_calls['apis']
+        assert streamed[0][0] < text.index('universe')
+        assert parser.text == text
+
+    def test_execute_query_stream_identify(self, monkeypatch):
+        api = AiApi(stream_identify=True)
+
+        @api.register_api()
+        def get_answer(question: str):
+            '''
+            Returns the answer to the question
+            '''
+            return len(question)
+
+        api_calls = {
+            "apis": [
+                {'name': 'get_answer', 'kwargs': {'question': 'life'}},
+                {'name': 'get_answer', 'kwargs': {'question': 'universe'}}
+            ]
+        }
+        text = json.dumps(api_calls)
+
+        async def stream_response():
+            for i in range(0, len(text), 7):
+                yield {'choices': [{'delta': {'content': text[i:i + 7]}}]}
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.ChatCompletion.acreate = AsyncMock(return_value=stream_response())
+
+        mock_answer_query = AsyncMock(return_value='42')
+        monkeypatch.setattr(api, 'answer_query_async', mock_answer_query)
+
+        assert api.execute_query('What is the answer?') == '42'
+        assert mock_openai.ChatCompletion.acreate.call_args.kwargs['stream'] is True
+
+        api_results = mock_answer_query.call_args[0][0]
+        assert [i['result'] for i in api_results['apis']] == [4, 8]
+
+    def test_execute_queries_async(self, monkeypatch):
+        api = AiApi(identify_cache_size=0)
+
+        @api.register_api()
+        async def get_answer(question: str):
+            '''
+            Returns the answer to the question
+            '''
+            await asyncio.sleep(.1)
+            return len(question)
+
+        async def identify_apis(query):
+            return {'apis': [{'name': 'get_answer', 'kwargs': {'question': query}}]}
+
+        async def answer_query(api_results, answer_prompts=None):
+            return api_results['apis'][0]['result']
+
+        monkeypatch.setattr(api, 'identify_apis_async', identify_apis)
+        monkeypatch.setattr(api, 'answer_query_async', answer_query)
+
+        async def run():
+            start = asyncio.get_running_loop().time()
+            answers = await api.execute_queries_async(['life', 'universe', 'everything'])
+            return answers, asyncio.get_running_loop().time() - start
+
+        answers, elapsed = asyncio.run(run())
+        assert answers == [4, 8, 10]
+        assert elapsed < .25
+
+    def test_execute_queries_batch(self, monkeypatch):
+        api = AiApi()
+        calls = []
+
+        @api.register_api(dedupe=True)
+        def get_answer(question: str):
+            '''
+            Returns the answer to the question
+            '''
+            calls.append(question)
+            return len(question)
+
+        uploads = []
+
+        async def create_file(file, purpose, user_provided_filename):
+            uploads.append([json.loads(line) for line in file.read().decode().splitlines()])
+            return {'id': f'file-{len(uploads)}'}
+
+        def download_file(file_id):
+            lines = []
+            for request in uploads[-1]:
+                if request['body']['temperature'] == api.api_temperature:
+                    question = 'life' if 'life' in request['body']['messages'][-1]['content'] else 'universe'
+                    content = json.dumps({'apis': [{'name': 'get_answer', 'kwargs': {'question': question}}]})
+                else:
+                    content = f"answer {json.loads(request['body']['messages'][-1]['content'])['apis'][0]['result']}"
+
+                lines.append(json.dumps({
+                    'custom_id': request['custom_id'],
+                    'response': {'status_code': 200, 'body': {'choices': [{'message': {'content': content}}]}}
+                }))
+            return "\n".join(lines).encode()
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.File.acreate = AsyncMock(side_effect=create_file)
+        mock_openai.File.download = MagicMock(side_effect=download_file)
+        mock_openai.api_requestor.APIRequestor.return_value.arequest = AsyncMock(
+            return_value=(MagicMock(data={'id': 'batch-1', 'status': 'completed', 'output_file_id': 'file-out'}), False, '')
+        )
+
+        queries = ['Meaning of life?', 'Size of the universe?', 'Meaning of life?']
+        assert api.execute_queries_batch(queries) == ['answer 4', 'answer 8', 'answer 4']
+
+        assert len(uploads) == 2
+        assert [len(batch) for batch in uploads] == [3, 3]
+        # Identical calls are only shared within a query, never across queries
+        assert sorted(calls) == ['life', 'life', 'universe']
+
+    def test_run_openai_batch_backoff(self, monkeypatch):
+        api = AiApi()
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.File.acreate = AsyncMock(return_value={'id': 'file-in'})
+        mock_openai.File.download = MagicMock(return_value=json.dumps({
+            'custom_id': '0', 'response': {'status_code': 200, 'body': {'choices': []}}
+        }).encode())
+
+        statuses = ['validating'] + ['in_progress'] * 7 + ['completed']
+        mock_openai.api_requestor.APIRequestor.return_value.arequest = AsyncMock(side_effect=[
+            (MagicMock(data={'id': 'batch-1', 'status': status, 'output_file_id': 'file-out'}), False, '')
+            for status in statuses
+        ])
+
+        delays = []
+        async def sleep(delay):
+            delays.append(delay)
+        monkeypatch.setattr('ai_api.asyncio.sleep', sleep)
+
+        assert asyncio.run(api._run_openai_batch({'0': {}}, '24h')) == {'0': {'choices': []}}
+        assert delays == [1, 2, 4, 8, 16, 32, 60, 60]
+
+    @pytest.mark.parametrize('batch, output', [
+        ({'id': 'batch-1', 'status': 'completed', 'output_file_id': None, 'error_file_id': 'file-err'}, b''),
+        ({'id': 'batch-1', 'status': 'completed', 'output_file_id': 'file-out'},
+         json.dumps({'custom_id': '0', 'response': None, 'error': {'message': 'failed'}}).encode()),
+    ])
+    def test_run_openai_batch_failed_requests(self, monkeypatch, batch, output):
+        api = AiApi()
+
+        mock_openai = MagicMock()
+        monkeypatch.setattr('ai_api.openai', mock_openai)
+        mock_openai.error.OpenAIError = openai.error.OpenAIError
+        mock_openai.File.acreate = AsyncMock(return_value={'id': 'file-in'})
+        mock_openai.File.download = MagicMock(return_value=output)
+        mock_openai.api_requestor.APIRequestor.return_value.arequest = AsyncMock(return_value=(MagicMock(data=batch), False, ''))
+
+        with pytest.raises(openai.error.OpenAIError):
+            asyncio.run(api._run_openai_batch({'0': {}}, '24h'))